@@ -2,13 +2,20 @@
     Mostly to prove we could have retired several years ago
 """
 import argparse
+import array
 import ast
+import contextlib
 import copy
 import datetime
 import json
+import math
+import os
+import random
+import sys
 
 # Configuration keys
 CONFIG_INFLATION = 'inflation' # annual inflation percentage
+CONFIG_INFLATION_STD_DEV = 'inflationStdDev' # uncertainty of inflation for stochastic runs
 CONFIG_BIRTH_YEAR = 'birthYear'
 
 CONFIG_START_YEAR = 'startYear'
@@ -35,6 +42,7 @@ CONFIG_ACCTS = 'accounts'
 CONFIG_ACCT_BALANCE = 'balance'
 CONFIG_ACCT_TARGET_BALANCE = 'targetBalance'
 CONFIG_ACCT_RETURN_RATE = 'returnRate'
+CONFIG_ACCT_RETURN_RATE_STD_DEV = 'returnRateStdDev' # uncertainty of returnRate for stochastic runs
 CONFIG_ACCT_SELL = 'sell'
 CONFIG_ACCT_MORTGAGE_RATE = 'mortgageRate'
 CONFIG_ACCT_MORTGAGE_PAYMENT = 'mortgagePayment'
@@ -67,6 +75,28 @@ OUTPUT_CELL = "<TD>{}</TD>"
 OUTPUT_CELL_RIGHT = "<TD style=\"text-align:right\">{}</TD>"
 OUTPUT_CURRENCY = "${:,.0f}"
 
+# Sampling methods for stochastic runs
+SAMPLING_RANDOM = 'random'
+SAMPLING_SOBOL = 'sobol'
+
+# Simulation engines
+ENGINE_REFERENCE = 'reference'
+ENGINE_FAST = 'fast'
+ENGINE_CENTS = 'cents'
+
+def get_int64_typecode():
+    """ Return the array type code of 64 bit integers or None if the platform has none """
+    for typecode in ('q', 'l'): # 'q' is not available before Python 3.3
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+# Array type code of int64 ledger columns
+LEDGER_INT64 = get_int64_typecode()
+
 #------------------ Account class
 
 class Account():
@@ -77,7 +107,7 @@ class Account():
         # Validate account config
         assert Config.eval(CONFIG_ACCT_BALANCE, cfg) is not None
         assert (CONFIG_ACCT_RETURN_RATE not in cfg
-                or Config.eval(CONFIG_ACCT_RETURN_RATE, cfg) >= 0.0
+                or Config.eval(CONFIG_ACCT_RETURN_RATE, cfg) >= Account.get_min_return_rate(cfg)
                )
         assert (CONFIG_ACCT_TARGET_BALANCE not in cfg
                 or Config.eval(CONFIG_ACCT_TARGET_BALANCE, cfg) >= 0.0
@@ -93,6 +123,14 @@ class Account():
         self.sell_year = Config.eval(CONFIG_ACCT_SELL, cfg)
         self.income_expenses_cfg = cfg.get(CONFIG_INCOME_EXPENSES)
 
+    @staticmethod
+    def get_min_return_rate(cfg):
+        """ Return the lowest accepted return rate. Return rates with an uncertainty are sampled in
+        stochastic runs and may be negative, but can't lose more than the whole balance. """
+        if CONFIG_ACCT_RETURN_RATE_STD_DEV in cfg:
+            return -1.0
+        return 0.0
+
     # pylint: disable=unused-argument
     def deposit(self, amount, appreciation):
         """ Deposit funds into account. Negative amount is a withdrawl.
@@ -169,14 +207,16 @@ class Investment(Account):
             # No tax implications
             self.transfer_to(account, amount)
         else:
-            pre_capital_gains_investment_amount = \
-                amount / \
-                (1 - (1 - self.basis / self.balance) * \
-                 self.year.get_capital_gains_tax_percentage())
+            pre_capital_gains_investment_amount = self.get_amount_plus_tax(amount)
             self.deposit(-pre_capital_gains_investment_amount, False)
             account.deposit(amount, False)
             account_for_tax.deposit(pre_capital_gains_investment_amount - amount, False)
 
+    def get_amount_plus_tax(self, amount):
+        """ Return the investment amount to sell so amount remains after capital gains tax """
+        return amount / \
+            (1 - (1 - self.basis / self.balance) * self.year.get_capital_gains_tax_percentage())
+
 #------------------ Mortgage class
 
 class Mortgage(Account):
@@ -199,6 +239,119 @@ class Mortgage(Account):
         # Mortgage payments over the year
         self.year.book(None, self.monthly_payment * -12, "Mortgage Payment", self)
 
+#------------------ CentsAccount classes
+
+class CentsAccount(Account, object):
+    """ Account keeping its balance as whole cents in the balance column of its year. Amounts are
+    rounded to the cent once when they enter or leave the account and are then added as integers,
+    so transfers move the exact same cents in and out.
+    Deriving from object as well makes the properties work with the classic Account class. """
+
+    def __init__(self, acct_name, cfg, year):
+        self.account_id = year.get_account_id(acct_name)
+        super(CentsAccount, self).__init__(acct_name, cfg, year)
+
+    def get_balance_cents(self):
+        """ Return balance in cents """
+        return self.year.balances[self.account_id]
+
+    def set_balance_cents(self, balance_cents):
+        """ Set balance in cents """
+        self.year.balances[self.account_id] = balance_cents
+
+    balance_cents = property(get_balance_cents, set_balance_cents)
+
+    def get_balance(self):
+        """ Return balance in dollars """
+        return Ledger.to_dollars(self.balance_cents)
+
+    def set_balance(self, balance):
+        """ Set balance, rounding to the cent """
+        self.balance_cents = Ledger.to_cents(balance)
+
+    balance = property(get_balance, set_balance)
+
+    def deposit(self, amount, appreciation):
+        """ Deposit funds rounded to the cent """
+        self.deposit_cents(Ledger.to_cents(amount), appreciation)
+
+    def deposit_cents(self, cents, appreciation):
+        """ Deposit whole cents """
+        self.balance_cents += cents
+
+    def transfer_to(self, account, amount):
+        """ Transfers amount rounded to the cent from this account to target account """
+        Account.transfer_to(self, account, Ledger.round_to_cent(amount))
+
+    def copy_to(self, year):
+        """ Return a copy of the account for year. The balance lives in the year's balance
+        column and all other state is immutable or read-only configuration, so a shallow copy
+        suffices. """
+        account = copy.copy(self)
+        account.year = year
+        return account
+
+    @staticmethod
+    def create_account(name, cfg, year):
+        """ Poor man's account factory for accounts kept in cents """
+
+        type_mapping = {CONFIG_ACCOUNT_TYPE_BASIC : CentsAccount,
+                        CONFIG_ACCOUNT_TYPE_MORTGAGE : CentsMortgage,
+                        CONFIG_ACCOUNT_TYPE_INVESTMENT : CentsInvestment}
+
+        return type_mapping[cfg[CONFIG_TYPE]](name, cfg, year)
+
+class CentsInvestment(CentsAccount, Investment):
+    """ Investment keeping balance and basis as whole cents """
+
+    def get_basis(self):
+        """ Return basis in dollars """
+        if self.basis_cents is None:
+            return None
+        return Ledger.to_dollars(self.basis_cents)
+
+    def set_basis(self, basis):
+        """ Set basis, rounding to the cent """
+        self.basis_cents = None
+        if basis is not None:
+            self.basis_cents = Ledger.to_cents(basis)
+
+    basis = property(get_basis, set_basis)
+
+    def deposit_cents(self, cents, appreciation):
+        """ Same as Investment.deposit in whole cents. The proportional basis reduction of a sale
+        is rounded half away from zero to the cent. """
+        if not appreciation:
+            if cents < 0:
+                basis_change = Ledger.divide(self.basis_cents * cents, self.balance_cents)
+                taxable = -cents + basis_change
+                self.basis_cents += basis_change
+                # Book capital gains incurred from sale
+                print 'Investment sale of ${} triggered capital gains of ${}' \
+                    .format(Ledger.to_dollars(-cents), Ledger.to_dollars(taxable))
+                self.year.book_tax(Ledger.to_dollars(taxable), TAX_CAPITAL_GAINS,
+                                   "Investment Gains")
+            else:
+                self.basis_cents += cents
+
+        CentsAccount.deposit_cents(self, cents, appreciation)
+
+    def transfer_to_plus_tax(self, account, amount, account_for_tax):
+        """ Rounds amount and the sale covering its tax to the cent once, so the funds set aside
+        for tax are exactly the sale minus amount """
+        if amount < 0:
+            # No tax implications
+            self.transfer_to(account, amount)
+        else:
+            cents = Ledger.to_cents(amount)
+            sale = Ledger.to_cents(self.get_amount_plus_tax(Ledger.to_dollars(cents)))
+            self.deposit_cents(-sale, False)
+            account.deposit_cents(cents, False)
+            account_for_tax.deposit_cents(sale - cents, False)
+
+class CentsMortgage(CentsAccount, Mortgage):
+    """ Mortgage keeping its principal as whole cents """
+
 #------------------ Year class
 
 class Year():
@@ -265,8 +418,11 @@ class Year():
             account = self.get_savings_account()
         account.deposit(amount, appreciation)
         self.books.append(BookEntry(account, amount, name, from_account))
+        Year.print_booking(account, amount, name, from_account)
 
-        # Print summary of booking
+    @staticmethod
+    def print_booking(account, amount, name, from_account):
+        """ Print summary of booking """
         if amount > 0:
             expense_income = "Income "
         else:
@@ -277,6 +433,10 @@ class Year():
         print '{}: {} applied to {} for {} {}' \
             .format(expense_income, amount, account.name, name, from_account_str)
 
+    def get_books(self):
+        """ Return all BookEntry objects of the year """
+        return self.books
+
     def get_book_entry(self, name, from_account_name):
         """ Return the BookEntry for a given name and from_account_name """
         for book_entry in self.books:
@@ -382,6 +542,136 @@ class Year():
         """ Sums up all line items with an amount < 0 """
         return sum(book_entry.amount for book_entry in self.books if book_entry.amount < 0)
 
+#------------------ FastYear class
+
+class FastYear(Year):
+    """ Optimized Year that must give the exact same results as the straightforward reference
+    implementation in Year. Use verify.py to check any change against the reference. """
+
+    def __init__(self, year, previous):
+        Year.__init__(self, year, previous)
+        # First book entry for each tuple of name and from_account name
+        self.book_index = {}
+
+    def init_accounts(self):
+        """ Get accounts ready for the year without copying all previous years along with the
+        accounts """
+        if not self.previous:
+            Year.init_accounts(self)
+        else:
+            # Accounts refer to their year, which refers to all previous years. Share rather than
+            # copy those, the references are replaced right after.
+            self.accounts = copy.deepcopy(self.previous.accounts,
+                                          {id(self.previous): self.previous})
+            for account in self.accounts.values():
+                account.year = self
+
+    def book(self, account, amount, name, from_account, appreciation=False):
+        """ Add transaction to books and index it for get_book_entry """
+        Year.book(self, account, amount, name, from_account, appreciation)
+        from_account_name = None
+        if from_account is not None:
+            from_account_name = from_account.name
+        self.book_index.setdefault((name, from_account_name), self.books[-1])
+
+    def get_book_entry(self, name, from_account_name):
+        """ Return the BookEntry for a given name and from_account_name """
+        return self.book_index.get((name, from_account_name))
+
+#------------------ CentsYear class
+
+class CentsYear(FastYear):
+    """ Year with bookings stored in the integer columns of a Ledger shared by all years and
+    account balances stored as whole cents in a balance column per year. Every booked amount and
+    every taxable event is rounded to the cent before it is applied, which makes totals exact and
+    reproducible. """
+
+    def __init__(self, year, previous):
+        FastYear.__init__(self, year, previous)
+        self.books = None # bookings are kept in the ledger, see get_books
+        self.books_cache = None
+        if previous is None:
+            self.ledger = Ledger()
+            self.balances = array.array(LEDGER_INT64)
+        else:
+            self.ledger = previous.ledger
+            # Accounts copied from the previous year start out from its balances
+            self.balances = previous.balances[:]
+        # Ledger rows of this year's bookings, which are contiguous
+        self.first_row = len(self.ledger)
+        self.end_row = self.first_row
+
+    def init_accounts(self):
+        """ Get accounts ready for the year, creating accounts kept in cents """
+        if not self.previous:
+            for acct_name in Config.cfg[CONFIG_ACCTS]:
+                acct_cfg = Config.cfg[CONFIG_ACCTS][acct_name]
+                self.accounts[acct_name] = CentsAccount.create_account(acct_name, acct_cfg, self)
+        else:
+            for acct_name, account in self.previous.accounts.items():
+                self.accounts[acct_name] = account.copy_to(self)
+
+    def get_account_id(self, acct_name):
+        """ Return the ledger id of an account, which also indexes its balance """
+        account_id = self.ledger.get_account_id(acct_name)
+        if account_id >= len(self.balances):
+            self.balances.extend([0] * (account_id + 1 - len(self.balances)))
+        return account_id
+
+    def get_books(self):
+        """ Return this year's bookings as BookEntry objects """
+        if self.books_cache is None or len(self.books_cache) != self.end_row - self.first_row:
+            self.books_cache = [self.get_ledger_book_entry(row)
+                                for row in range(self.first_row, self.end_row)]
+        return self.books_cache
+
+    def get_ledger_book_entry(self, row):
+        """ Return the BookEntry for a ledger row of this year """
+        name, account_name, from_account_name, amount = self.ledger.get_row(row)
+        from_account = None
+        if from_account_name is not None:
+            from_account = self.accounts[from_account_name]
+        return BookEntry(self.accounts[account_name], amount, name, from_account)
+
+    def book(self, account, amount, name, from_account, appreciation=False):
+        """ Add transaction rounded to the cent to the ledger and transfer funds to account
+        accordingly """
+        if account is None:
+            # If account not specified default to savings account
+            account = self.get_savings_account()
+        cents = Ledger.to_cents(amount)
+        account.deposit_cents(cents, appreciation)
+        from_account_name = None
+        if from_account is not None:
+            from_account_name = from_account.name
+        row = self.ledger.append(name, account.name, from_account_name, cents)
+        self.end_row = row + 1
+        self.book_index.setdefault((name, from_account_name), row)
+        Year.print_booking(account, Ledger.to_dollars(cents), name, from_account)
+
+    def get_book_entry(self, name, from_account_name):
+        """ Return the BookEntry for a given name and from_account_name """
+        row = self.book_index.get((name, from_account_name))
+        if row is None:
+            return None
+        return self.get_books()[row - self.first_row]
+
+    def book_tax(self, amount, tax_type, name):
+        """ Record all taxable events rounded to the cent """
+        Year.book_tax(self, Ledger.round_to_cent(amount), tax_type, name)
+
+    def get_net_worth(self):
+        """ Return net worth as the exact sum of the balance column """
+        return Ledger.to_dollars(sum(self.balances))
+
+    def get_total_income(self):
+        """ Sums up all line items with an amount > 0 """
+        return Ledger.to_dollars(self.ledger.get_total_income(self.first_row, self.end_row))
+
+    def get_total_expenses(self):
+        """ Sums up all line items with an amount < 0 """
+        return Ledger.to_dollars(self.ledger.get_total_expenses(self.first_row, self.end_row))
+
 #------------------ BookEntry class
 
 class BookEntry():
@@ -404,6 +694,99 @@ class TaxBookEntry():
         self.name = name
         self.processed = False
 
+#------------------ Ledger class
+
+class Ledger():
+    """ Book entries of all years stored as whole cents in int64 columns. Names are stored as
+    ids into name tables. Amounts are rounded half away from zero to the cent. The rows of a year
+    are contiguous, so years refer to their bookings by row range. """
+    NO_ACCOUNT = -1 # account id of book entries without from_account
+
+    def __init__(self):
+        assert LEDGER_INT64 is not None, "no 64 bit integer array type available"
+        self.name_ids = array.array(LEDGER_INT64)
+        self.account_ids = array.array(LEDGER_INT64)
+        self.from_account_ids = array.array(LEDGER_INT64)
+        self.amounts = array.array(LEDGER_INT64)
+        # Name tables and their reverse lookups
+        self.names = []
+        self.name_index = {}
+        self.account_names = []
+        self.account_name_index = {}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    @staticmethod
+    def to_cents(amount):
+        """ Return amount in dollars as whole cents, rounding half away from zero """
+        cents = int(math.floor(abs(amount) * 100 + 0.5))
+        if amount < 0:
+            return -cents
+        return cents
+
+    @staticmethod
+    def to_dollars(cents):
+        """ Return whole cents as amount in dollars """
+        return cents / 100.0
+
+    @staticmethod
+    def round_to_cent(amount):
+        """ Return amount in dollars rounded to the cent """
+        return Ledger.to_dollars(Ledger.to_cents(amount))
+
+    @staticmethod
+    def divide(numerator, denominator):
+        """ Return the integer quotient rounded half away from zero """
+        quotient, remainder = divmod(abs(numerator), abs(denominator))
+        if 2 * remainder >= abs(denominator):
+            quotient += 1
+        if (numerator < 0) != (denominator < 0):
+            return -quotient
+        return quotient
+
+    @staticmethod
+    def get_id(name, names, name_index):
+        """ Return the id of name, adding it to the name table if needed """
+        if name not in name_index:
+            name_index[name] = len(names)
+            names.append(name)
+        return name_index[name]
+
+    def get_account_id(self, account_name):
+        """ Return the id of account_name """
+        return Ledger.get_id(account_name, self.account_names, self.account_name_index)
+
+    def append(self, name, account_name, from_account_name, cents):
+        """ Add a booking of cents and return its row """
+        from_account_id = Ledger.NO_ACCOUNT
+        if from_account_name is not None:
+            from_account_id = self.get_account_id(from_account_name)
+        self.name_ids.append(Ledger.get_id(name, self.names, self.name_index))
+        self.account_ids.append(self.get_account_id(account_name))
+        self.from_account_ids.append(from_account_id)
+        self.amounts.append(cents)
+        return len(self.amounts) - 1
+
+    def get_row(self, row):
+        """ Return name, account name, from_account name and amount in dollars of a row """
+        from_account_name = None
+        if self.from_account_ids[row] != Ledger.NO_ACCOUNT:
+            from_account_name = self.account_names[self.from_account_ids[row]]
+        return (self.names[self.name_ids[row]], self.account_names[self.account_ids[row]],
+                from_account_name, Ledger.to_dollars(self.amounts[row]))
+
+    def get_total_income(self, first_row, end_row):
+        """ Return the sum of positive amounts in a range of rows in cents """
+        amounts = self.amounts[first_row:end_row]
+        # Positive amounts count twice in the sum of absolute values plus the plain sum
+        return (sum(map(abs, amounts)) + sum(amounts)) // 2
+
+    def get_total_expenses(self, first_row, end_row):
+        """ Return the sum of negative amounts in a range of rows in cents """
+        amounts = self.amounts[first_row:end_row]
+        return (sum(amounts) - sum(map(abs, amounts))) // 2
+
 #------------------ BasicBookEntryHelper class
 
 class BasicBookEntryHelper():
@@ -476,8 +859,8 @@ class Config(ast.NodeTransformer):
     def validate():
         """ Reviews configuration settings for correctness """
         # TBD Need consistent validation and align with validations spread out in other areas
-        assert Config.eval(CONFIG_INFLATION, Config.cfg) >= 0 and \
-               Config.eval(CONFIG_INFLATION, Config.cfg) <= 1
+        assert Config.eval(CONFIG_INFLATION, Config.cfg) >= Config.get_min_inflation(Config.cfg) \
+               and Config.eval(CONFIG_INFLATION, Config.cfg) <= 1
         assert Config.eval(CONFIG_BIRTH_YEAR, Config.cfg) >= 0 and \
                Config.eval(CONFIG_BIRTH_YEAR, Config.cfg) <= datetime.datetime.now().year
 
@@ -490,6 +873,14 @@ class Config(ast.NodeTransformer):
 
         assert Config.cfg[CONFIG_ACCTS] is not None and len(Config.cfg[CONFIG_ACCTS]) > 0
 
+    @staticmethod
+    def get_min_inflation(cfg):
+        """ Return the lowest accepted inflation. Inflation with an uncertainty is sampled in
+        stochastic runs and may turn into deflation, but prices can't drop by more than all. """
+        if CONFIG_INFLATION_STD_DEV in cfg:
+            return -1.0
+        return 0.0
+
     @staticmethod
     def eval(key, cfg):
         """ Evaluate the key's value, resolving variables from global configuration as needed. """
@@ -585,7 +976,7 @@ class Output():
         tell whether it's an income or expense."""
         income_expense_types = {}
         for year in years:
-            for book_entry in year.books:
+            for book_entry in year.get_books():
                 if book_entry.amount > 0:
                     book_entry_type = INCOME_EXPENSE_TYPE_INCOME
                 elif book_entry.amount < 0:
@@ -671,32 +1062,369 @@ class Output():
 
             outf.write("</TABLE></BODY></HTML>\n")
 
-#------------------ Main loop
+#------------------ Sobol class
+
+class Sobol():
+    """ Sobol low discrepancy sequence in Gray code order. A random digital shift drawn from the
+    provided random number generator makes the sequence reproducible for a given seed while
+    keeping its stratification. """
+    BITS = 30
+    # Degree, polynomial coefficients and initial direction numbers of dimensions 2 and up
+    # (Joe & Kuo). Dimension 1 is the van der Corput sequence.
+    DIRECTIONS = [(1, 0, [1]),
+                  (2, 1, [1, 3]),
+                  (3, 1, [1, 3, 1]),
+                  (3, 2, [1, 1, 1]),
+                  (4, 1, [1, 1, 3, 3]),
+                  (4, 4, [1, 3, 5, 13]),
+                  (5, 2, [1, 1, 5, 5, 17]),
+                  (5, 4, [1, 1, 5, 5, 5]),
+                  (5, 7, [1, 1, 7, 11, 19]),
+                  (5, 11, [1, 1, 5, 1, 1]),
+                  (5, 13, [1, 1, 1, 3, 11]),
+                  (5, 14, [1, 3, 5, 5, 31])]
+    MAX_DIMENSIONS = len(DIRECTIONS) + 1
+
+    def __init__(self, dimensions, rng):
+        assert dimensions <= Sobol.MAX_DIMENSIONS
+        self.directions = []
+        if dimensions > 0:
+            self.directions.append([1 << (Sobol.BITS - 1 - k) for k in range(Sobol.BITS)])
+        for degree, coefficients, initial in Sobol.DIRECTIONS[:max(dimensions - 1, 0)]:
+            directions = [initial[k] << (Sobol.BITS - 1 - k) for k in range(degree)]
+            for k in range(degree, Sobol.BITS):
+                direction = directions[k - degree] ^ (directions[k - degree] >> degree)
+                for bit in range(1, degree):
+                    if (coefficients >> (degree - 1 - bit)) & 1:
+                        direction ^= directions[k - bit]
+                directions.append(direction)
+            self.directions.append(directions)
+        self.point = [0] * dimensions
+        self.shift = [rng.getrandbits(Sobol.BITS) for _ in range(dimensions)]
+        self.index = 0
+
+    def next(self):
+        """ Return the next point of the sequence as a list of values in (0, 1) """
+        result = [((value ^ shift) + 0.5) / (1 << Sobol.BITS)
+                  for value, shift in zip(self.point, self.shift)]
+        # Gray code ordering only flips the direction number of the lowest zero bit of the index
+        bit = 0
+        while (self.index >> bit) & 1:
+            bit += 1
+        for dimension, directions in enumerate(self.directions):
+            self.point[dimension] ^= directions[bit]
+        self.index += 1
+        return result
+
+#------------------ Sampler class
+
+class Sampler():
+    """ Seeded source of standard normal draws for stochastic runs. Draws are based on either
+    pseudo random or Sobol quasi random numbers and optionally come in antithetic pairs. """
+    def __init__(self, dimensions, seed, method, antithetic):
+        self.dimensions = dimensions
+        self.antithetic = antithetic
+        self.rng = random.Random(seed)
+        self.sobol = None
+        if method == SAMPLING_SOBOL:
+            self.sobol = Sobol(dimensions, self.rng)
+        else:
+            assert method == SAMPLING_RANDOM # TBD how to raise error if method not supported
+
+    def uniform(self):
+        """ Return the next vector of uniform values in (0, 1) """
+        if self.sobol is not None:
+            return self.sobol.next()
+        return [self.rng.random() for _ in range(self.dimensions)]
+
+    def draw(self, count):
+        """ Return count vectors of standard normal values. With antithetic variates every
+        second vector is the negation of the one before, so count needs to be even. """
+        draws = []
+        while len(draws) < count:
+            draw = [Sampler.inverse_normal_cdf(value) for value in self.uniform()]
+            draws.append(draw)
+            if self.antithetic:
+                draws.append([-value for value in draw])
+        assert len(draws) == count
+        return draws
 
-def main():
-    """ Program main entry point """
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--config", help="configuration file", default="Configuration.json")
-    parser.add_argument("-a", "--age", help="age when simulation ends", default=100)
-    args = parser.parse_args()
+    @staticmethod
+    def inverse_normal_cdf(probability):
+        """ Return the standard normal quantile of probability by bisection """
+        low, high = -10.0, 10.0
+        for _ in range(60):
+            middle = (low + high) / 2
+            if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < probability:
+                low = middle
+            else:
+                high = middle
+        return (low + high) / 2
 
-    Config.init(args.config)
+#------------------ StochasticSimulation class
+
+class StochasticSimulation():
+    # pylint: disable=too-many-instance-attributes
+    """ Estimates the plan success probability and the median final net worth when inflation
+    and account return rates are uncertain. Each path draws inflation and return rates once from
+    normal distributions around the configured values with the configured standard deviations.
+    Draws outside the accepted range, inflation from -1 to 1 and return rates of at least -1, are
+    clamped and a warning reports how often that happened.
+    A path succeeds if net worth never turns negative. Paths always run through the end year, so
+    final net worth is the net worth of the end year even for failed paths.
+    Paths are spread over independent replicates, each with its own sampler. Confidence
+    intervals derive from the spread of the replicate estimates, which keeps them valid for quasi
+    random and antithetic sampling. Batches of paths are added until the confidence intervals of
+    both estimates are within tolerance or the path budget is used up. """
+    # Student t quantiles for two sided 95% confidence by degrees of freedom
+    CONFIDENCE_T = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31,
+                    9: 2.26, 10: 2.23, 15: 2.13, 20: 2.09, 30: 2.04, 60: 2.00, 120: 1.98}
+    # Share of paths with a clamped value that triggers a warning
+    CLAMPED_WARNING = 0.01
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, start_year, end_year, samplers, batch_size, max_paths, tolerance,
+                 net_worth_tolerance, engine=ENGINE_FAST):
+        self.start_year = start_year
+        self.end_year = end_year
+        self.engine = engine
+        self.samplers = samplers
+        self.batch_size = batch_size
+        self.max_paths = max_paths
+        self.tolerance = tolerance
+        self.net_worth_tolerance = net_worth_tolerance
+        # Results of each replicate's paths
+        self.successes = [[] for _ in samplers]
+        self.final_net_worths = [[] for _ in samplers]
+        # Number of paths with a clamped value for each uncertain value
+        self.clamped = {}
+
+    @staticmethod
+    def get_uncertain_values(cfg):
+        """ Return all configured uncertain values as a list of tuples of
+        - account name or None for global configuration
+        - configuration key
+        - mean, standard deviation, lower bound and upper bound of the value """
+        uncertain_values = []
+        if CONFIG_INFLATION_STD_DEV in cfg:
+            uncertain_values.append((None, CONFIG_INFLATION, Config.eval(CONFIG_INFLATION, cfg),
+                                     Config.eval(CONFIG_INFLATION_STD_DEV, cfg),
+                                     Config.get_min_inflation(cfg), 1.0))
+        for acct_name in sorted(cfg[CONFIG_ACCTS]):
+            acct_cfg = cfg[CONFIG_ACCTS][acct_name]
+            if CONFIG_ACCT_RETURN_RATE_STD_DEV in acct_cfg:
+                uncertain_values.append((acct_name, CONFIG_ACCT_RETURN_RATE,
+                                         Config.eval(CONFIG_ACCT_RETURN_RATE, acct_cfg) or 0.0,
+                                         Config.eval(CONFIG_ACCT_RETURN_RATE_STD_DEV, acct_cfg),
+                                         Account.get_min_return_rate(acct_cfg), None))
+        return uncertain_values
+
+    @staticmethod
+    def create_samplers(cfg, seed, method, antithetic, replicates):
+        """ Return one sampler per replicate, seeded reproducibly from seed """
+        rng = random.Random(seed)
+        dimensions = len(StochasticSimulation.get_uncertain_values(cfg))
+        return [Sampler(dimensions, rng.getrandbits(32), method, antithetic)
+                for _ in range(replicates)]
+
+    def run_path(self, cfg, uncertain_values, draw):
+        """ Simulate a single path with the uncertain values set from draw.
+        Returns whether the path succeeded and the final net worth. """
+        path_cfg = copy.deepcopy(cfg)
+        for uncertain_value, value in zip(uncertain_values, draw):
+            acct_name, key, mean, std_dev, lower, upper = uncertain_value
+            # Keep sampled values within the ranges accepted by configuration validation
+            value = mean + std_dev * value
+            if value < lower or (upper is not None and value > upper):
+                value = max(lower, value)
+                if upper is not None:
+                    value = min(upper, value)
+                self.clamped[uncertain_value] = self.clamped.get(uncertain_value, 0) + 1
+            if acct_name is None:
+                path_cfg[key] = value
+            else:
+                path_cfg[CONFIG_ACCTS][acct_name][key] = value
+        Config.cfg = path_cfg
+        years = simulate(self.start_year, self.end_year, self.engine, False)
+        success = all(year.get_net_worth() >= 0 for year in years)
+        return success, years[-1].get_net_worth()
+
+    def get_paths(self):
+        """ Return the number of simulated paths """
+        return sum(len(successes) for successes in self.successes)
+
+    def get_estimate(self, replicate_estimates):
+        """ Return average and confidence interval half width of the replicate estimates """
+        count = len(replicate_estimates)
+        mean = sum(replicate_estimates) / count
+        variance = sum((estimate - mean) ** 2 for estimate in replicate_estimates) \
+            / max(count - 1, 1)
+        # Use the nearest tabulated degrees of freedom that doesn't overstate confidence
+        confidence = StochasticSimulation.CONFIDENCE_T[
+            max(degrees for degrees in StochasticSimulation.CONFIDENCE_T if degrees <= count - 1)]
+        return mean, confidence * math.sqrt(variance / count)
+
+    def get_success_probability(self):
+        """ Return estimate and confidence interval half width of the success probability """
+        success_probability, half_width = \
+            self.get_estimate([sum(successes) / len(successes) for successes in self.successes])
+        if success_probability in (0.0, 1.0):
+            # No variation observed yet, fall back to the rule of three
+            half_width = 3.0 / self.get_paths()
+        return success_probability, half_width
+
+    def get_median_final_net_worth(self):
+        """ Return estimate and confidence interval half width of the median final net worth """
+        medians = []
+        for final_net_worths in self.final_net_worths:
+            final_net_worths = sorted(final_net_worths)
+            count = len(final_net_worths)
+            medians.append((final_net_worths[(count - 1) // 2]
+                            + final_net_worths[count // 2]) / 2)
+        return self.get_estimate(medians)
+
+    def is_precise(self):
+        """ Check if both estimates are within tolerance """
+        half_width = self.get_success_probability()[1]
+        median, median_half_width = self.get_median_final_net_worth()
+        return (half_width <= self.tolerance and
+                median_half_width <= self.net_worth_tolerance * max(abs(median), 1.0))
+
+    def get_batch_paths_per_replicate(self):
+        """ Return the paths per replicate of the next batch, limited to the remaining budget.
+        Antithetic pairs are never split. """
+        paths = min(self.batch_size, self.max_paths - self.get_paths()) // len(self.samplers)
+        if self.samplers[0].antithetic:
+            paths -= paths % 2
+        return paths
+
+    def run(self):
+        """ Add batches of paths until the estimates are precise enough.
+        Returns the success probability and median final net worth estimates. """
+        cfg = Config.cfg
+        uncertain_values = StochasticSimulation.get_uncertain_values(cfg)
+        try:
+            while self.get_batch_paths_per_replicate() > 0:
+                paths = self.get_batch_paths_per_replicate()
+                for replicate, sampler in enumerate(self.samplers):
+                    for draw in sampler.draw(paths):
+                        with quiet():
+                            success, final_net_worth = self.run_path(cfg, uncertain_values, draw)
+                        self.successes[replicate].append(1.0 if success else 0.0)
+                        self.final_net_worths[replicate].append(final_net_worth)
+                success_probability, half_width = self.get_success_probability()
+                median, median_half_width = self.get_median_final_net_worth()
+                print 'Paths {}: success probability {:.4f} +/- {:.4f}, ' \
+                      'median end year net worth {} +/- {}' \
+                    .format(self.get_paths(), success_probability, half_width,
+                            OUTPUT_CURRENCY.format(median),
+                            OUTPUT_CURRENCY.format(median_half_width))
+                if self.is_precise():
+                    break
+        finally:
+            Config.cfg = cfg
+        for (acct_name, key, _, _, _, _), clamped in sorted(self.clamped.items()):
+            if clamped > StochasticSimulation.CLAMPED_WARNING * self.get_paths():
+                print 'Warning: {}{} clamped to its accepted range in {:.1%} of paths' \
+                    .format(key, '' if acct_name is None else ' of ' + acct_name,
+                            float(clamped) / self.get_paths())
+        return self.get_success_probability(), self.get_median_final_net_worth()
+
+#------------------ Main loop
+
+ENGINES = {ENGINE_REFERENCE : Year,
+           ENGINE_FAST : FastYear,
+           ENGINE_CENTS : CentsYear}
+
+@contextlib.contextmanager
+def quiet():
+    """ Suppress the console trace of simulations run within the context """
+    stdout = sys.stdout
+    with open(os.devnull, "w") as sys.stdout:
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+def simulate(start_year, end_year, engine=ENGINE_FAST, stop_when_destitute=True):
+    """ Run the year by year simulation with the current configuration. By default stops early
+    once net worth turns negative. Returns the list of simulated years. """
     years = []
     previous = None
-    for year in range(datetime.datetime.now().year,
-                      Config.eval(CONFIG_BIRTH_YEAR, Config.cfg) + int(args.age) + 1):
+    for year in range(start_year, end_year + 1):
 
         # Instantiate new year, copying from previous
-        current = Year(year, previous)
+        current = ENGINES[engine](year, previous)
         current.process()
 
         # Store results of all years
         years.append(current)
         previous = current
-        if current.get_net_worth() < 0:
+        if current.get_net_worth() < 0 and stop_when_destitute:
             print 'Destitute on year {}'.format(year)
             break
+    return years
 
+def main():
+    """ Program main entry point """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="configuration file", default="Configuration.json")
+    parser.add_argument("-a", "--age", help="age when simulation ends", default=100)
+    parser.add_argument("-e", "--engine", help="simulation engine", choices=sorted(ENGINES),
+                        default=ENGINE_FAST)
+    parser.add_argument("-s", "--stochastic", action="store_true",
+                        help="estimate success probability under uncertain inflation and returns")
+    parser.add_argument("--seed", help="random seed of stochastic runs", type=int, default=0)
+    parser.add_argument("--sampling", help="sampling method of stochastic runs",
+                        choices=[SAMPLING_RANDOM, SAMPLING_SOBOL], default=SAMPLING_SOBOL)
+    parser.add_argument("--antithetic", action="store_true",
+                        help="use antithetic variates in stochastic runs")
+    parser.add_argument("--replicates", help="independent replicates of stochastic runs",
+                        type=int, default=16)
+    parser.add_argument("--batch-size", help="paths added per batch in stochastic runs", type=int,
+                        default=64)
+    parser.add_argument("--max-paths", type=int, default=100000,
+                        help="maximum paths of stochastic runs, rounded down to whole paths or "
+                             "antithetic pairs per replicate")
+    parser.add_argument("--tolerance", type=float, default=0.01,
+                        help="confidence interval half width of success probability")
+    parser.add_argument("--net-worth-tolerance", type=float, default=0.01,
+                        help="confidence interval half width of median end year net worth "
+                             "relative to the median")
+    args = parser.parse_args()
+
+    if args.engine == ENGINE_CENTS and LEDGER_INT64 is None:
+        parser.error("the cents engine needs 64 bit integer arrays, which this Python lacks")
+
+    Config.init(args.config)
+    start_year = datetime.datetime.now().year
+    end_year = Config.eval(CONFIG_BIRTH_YEAR, Config.cfg) + int(args.age)
+
+    if args.stochastic:
+        if args.replicates < 2:
+            parser.error("--replicates must be at least 2 to estimate confidence intervals")
+        if args.batch_size % args.replicates:
+            parser.error("--batch-size must be a multiple of --replicates")
+        if args.antithetic and args.batch_size // args.replicates % 2:
+            parser.error("--antithetic needs an even number of paths per replicate in a batch")
+        if args.max_paths < args.replicates * (2 if args.antithetic else 1):
+            parser.error("--max-paths must allow at least one path per replicate, "
+                         "or one antithetic pair per replicate")
+        dimensions = len(StochasticSimulation.get_uncertain_values(Config.cfg))
+        if dimensions == 0:
+            parser.error("stochastic runs need inflationStdDev or an account returnRateStdDev "
+                         "in the configuration")
+        if args.sampling == SAMPLING_SOBOL and dimensions > Sobol.MAX_DIMENSIONS:
+            parser.error("sobol sampling supports at most {} uncertain values, {} configured"
+                         .format(Sobol.MAX_DIMENSIONS, dimensions))
+        samplers = StochasticSimulation.create_samplers(Config.cfg, args.seed, args.sampling,
+                                                        args.antithetic, args.replicates)
+        StochasticSimulation(start_year, end_year, samplers, args.batch_size, args.max_paths,
+                             args.tolerance, args.net_worth_tolerance, args.engine).run()
+        return
+
+    years = simulate(start_year, end_year, args.engine)
     Output.output_years_html(years)
 
-main()
+if __name__ == '__main__':
+    main()
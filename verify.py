@@ -0,0 +1,337 @@
+""" Differential verification of simulation engines
+    Runs fuzzed configurations through the reference engine and an optimized engine and reports
+    any difference in per year balances, book entries and taxes along with the speed-up.
+"""
+import argparse
+import copy
+import datetime
+import json
+import random
+import sys
+import time
+
+import main
+
+# Extra top level variables that fuzzed expressions refer to
+VARIABLE_RETIREMENT = 'retirementYear'
+VARIABLE_RAISE = 'raisePercent'
+VARIABLE_SALARY = 'salary'
+
+# Keys that minimization never removes since every configuration needs them
+REQUIRED_KEYS = [main.CONFIG_NAME, main.CONFIG_TYPE, main.CONFIG_AMOUNT, main.CONFIG_ACCT_BALANCE,
+                 main.CONFIG_PERCENT]
+
+# Book and tax entries below a cent may exist in one engine only, for example when a sub-cent
+# difference from a rebalancing target triggers a transfer
+SUB_CENT = 0.005
+
+# Default relative and absolute tolerances of amounts by engine. Rounding in the cents engine
+# compounds over the years, these pass fuzzed configs of 60 years.
+TOLERANCES = {main.ENGINE_CENTS: (1e-5, 25.0)}
+DEFAULT_TOLERANCES = (1e-9, 1e-6)
+
+#------------------ ConfigFuzzer class
+
+class ConfigFuzzer():
+    """ Generates random valid configurations covering all account types, nested increase lists,
+    variable references and sell years """
+    def __init__(self, rng, start_year):
+        self.rng = rng
+        self.start_year = start_year
+
+    def year(self):
+        """ Return a year within the first decades of the simulation, possibly as an expression """
+        offset = self.rng.randint(0, 30)
+        return self.rng.choice([self.start_year + offset,
+                                '{}{:+}'.format(VARIABLE_RETIREMENT, offset - 15)])
+
+    def amount(self, low, high):
+        """ Return an amount, possibly as an expression """
+        amount = round(self.rng.uniform(low, high), 2)
+        return self.rng.choice([amount, str(amount),
+                                '{}*{}'.format(VARIABLE_SALARY, round(amount / 100000, 4))])
+
+    def year_filter(self, cfg):
+        """ Randomly restrict cfg to a range of years """
+        if self.rng.random() < 0.4:
+            cfg[main.CONFIG_START_YEAR] = self.year()
+        if self.rng.random() < 0.4:
+            cfg[main.CONFIG_END_YEAR] = self.year()
+        return cfg
+
+    def increase(self):
+        """ Return an increase as single value, single dictionary or list of dictionaries """
+        choice = self.rng.randint(0, 3)
+        if choice == 0:
+            return self.rng.choice([round(self.rng.uniform(-0.05, 0.1), 3), VARIABLE_RAISE])
+        increases = []
+        for _ in range(self.rng.randint(1, 4)):
+            if self.rng.random() < 0.5:
+                increase = {main.CONFIG_PERCENT : round(self.rng.uniform(-0.05, 0.1), 3)}
+            else:
+                increase = {main.CONFIG_AMOUNT : self.amount(-5000, 5000)}
+            increases.append(self.year_filter(increase))
+        if choice == 1:
+            return increases[0]
+        return increases
+
+    def income_expense(self, name, low, high):
+        """ Return a basic income or expense configuration """
+        cfg = {main.CONFIG_TYPE : main.CONFIG_LINE_ITEM_TYPE_BASIC,
+               main.CONFIG_NAME : name,
+               main.CONFIG_INCOME_EXPENSE_AMOUNT : self.amount(low, high)}
+        if self.rng.random() < 0.5:
+            cfg[main.CONFIG_INCOME_EXPENSE_INCREASE] = self.increase()
+        if self.rng.random() < 0.5:
+            cfg[main.CONFIG_INCOME_EXPENSE_INFLATION_ADJUST] = None
+        return self.year_filter(cfg)
+
+    def account(self, index):
+        """ Return a random account configuration of any type """
+        acct_type = self.rng.choice([main.CONFIG_ACCOUNT_TYPE_BASIC,
+                                     main.CONFIG_ACCOUNT_TYPE_MORTGAGE,
+                                     main.CONFIG_ACCOUNT_TYPE_INVESTMENT])
+        if acct_type == main.CONFIG_ACCOUNT_TYPE_MORTGAGE:
+            return {main.CONFIG_TYPE : acct_type,
+                    main.CONFIG_ACCT_BALANCE : self.amount(-500000, -10000),
+                    main.CONFIG_MORTGAGE_MONTHLY_PAYMENT : self.amount(500, 3000)}
+        cfg = {main.CONFIG_TYPE : acct_type,
+               main.CONFIG_ACCT_BALANCE : self.amount(1000, 1000000)}
+        if acct_type == main.CONFIG_ACCOUNT_TYPE_INVESTMENT:
+            cfg[main.CONFIG_INVESTMENT_BASIS] = self.amount(0, 1000)
+        if self.rng.random() < 0.7:
+            cfg[main.CONFIG_ACCT_RETURN_RATE] = round(self.rng.uniform(0, 0.1), 3)
+        if self.rng.random() < 0.5:
+            cfg[main.CONFIG_ACCT_SELL] = self.year()
+        if self.rng.random() < 0.3:
+            cfg[main.CONFIG_INCOME_EXPENSES] = self.income_expense('Upkeep {}'.format(index),
+                                                                   -20000, -100)
+        return cfg
+
+    def config(self):
+        """ Return a random valid configuration """
+        cfg = {main.CONFIG_INFLATION : self.rng.choice([0.0, 0.02, '0.01+0.015']),
+               main.CONFIG_BIRTH_YEAR : self.start_year - self.rng.randint(25, 60),
+               VARIABLE_RETIREMENT : self.start_year + self.rng.randint(0, 20),
+               VARIABLE_RAISE : round(self.rng.uniform(0, 0.05), 3),
+               VARIABLE_SALARY : self.rng.randint(50000, 200000)}
+        accounts = {main.KEY_SAVINGS_ACCT : {main.CONFIG_TYPE : main.CONFIG_ACCOUNT_TYPE_BASIC,
+                                             main.CONFIG_ACCT_BALANCE : self.amount(0, 100000),
+                                             main.CONFIG_ACCT_TARGET_BALANCE :
+                                                 self.rng.randint(0, 50000)},
+                    # Rebalancing only draws from the account named Investment
+                    'Investment' : {main.CONFIG_TYPE : main.CONFIG_ACCOUNT_TYPE_INVESTMENT,
+                                    main.CONFIG_ACCT_BALANCE : self.amount(100000, 2000000),
+                                    main.CONFIG_INVESTMENT_BASIS : self.amount(1000, 100000),
+                                    main.CONFIG_ACCT_RETURN_RATE :
+                                        round(self.rng.uniform(0, 0.1), 3)}}
+        for index in range(self.rng.randint(0, 4)):
+            accounts['Account {}'.format(index)] = self.account(index)
+        cfg[main.CONFIG_ACCTS] = accounts
+        income_expenses = [self.income_expense('Work', 20000, 200000)]
+        income_expenses[0][main.CONFIG_INCOME_EXPENSE_AMOUNT] = VARIABLE_SALARY
+        income_expenses[0][main.CONFIG_END_YEAR] = '{}-1'.format(VARIABLE_RETIREMENT)
+        for index in range(self.rng.randint(0, 4)):
+            income_expenses.append(self.income_expense('Income {}'.format(index), 0, 50000))
+        for index in range(self.rng.randint(1, 4)):
+            income_expenses.append(self.income_expense('Expense {}'.format(index),
+                                                       -100000, -1000))
+        cfg[main.CONFIG_INCOME_EXPENSES] = income_expenses
+        return cfg
+
+#------------------ Verifier class
+
+class Verifier():
+    """ Compares an optimized engine against the reference engine """
+    def __init__(self, engine, start_year, rel_tolerance, abs_tolerance):
+        self.engine = engine
+        self.start_year = start_year
+        self.rel_tolerance = rel_tolerance
+        self.abs_tolerance = abs_tolerance
+
+    def run(self, cfg, years, engine):
+        """ Simulate cfg with engine. Returns the simulated years and the run time. """
+        main.Config.cfg = copy.deepcopy(cfg)
+        main.Config.validate()
+        with main.quiet():
+            start = time.time()
+            simulated_years = main.simulate(self.start_year, self.start_year + years - 1, engine)
+            elapsed = time.time() - start
+        return simulated_years, elapsed
+
+    @staticmethod
+    def get_results(years):
+        """ Return the results of each year as comparable tuples of names and amounts """
+        results = []
+        for year in years:
+            results.append((year.year, 'balances',
+                            sorted((name, account.balance)
+                                   for name, account in year.accounts.items())))
+            books = []
+            for book_entry in year.get_books():
+                from_account_name = None
+                if book_entry.from_account is not None:
+                    from_account_name = book_entry.from_account.name
+                books.append(((book_entry.name, book_entry.account.name, from_account_name),
+                              book_entry.amount))
+            results.append((year.year, 'books', books))
+            results.append((year.year, 'taxes',
+                            [((tax_book_entry.name, tax_book_entry.tax_type),
+                              tax_book_entry.amount) for tax_book_entry in year.tax_books]))
+            results.append((year.year, 'totals',
+                            [('net worth', year.get_net_worth()),
+                             ('income', year.get_total_income()),
+                             ('expenses', year.get_total_expenses())]))
+        return results
+
+    def is_close(self, reference, optimized):
+        """ Check if optimized amount is within tolerance of reference amount """
+        return abs(reference - optimized) <= \
+            max(self.abs_tolerance, self.rel_tolerance * abs(reference))
+
+    def compare(self, reference_years, optimized_years):
+        """ Return description of the first difference or None if results match """
+        if len(reference_years) != len(optimized_years):
+            return 'simulated {} years instead of {}'.format(len(optimized_years),
+                                                             len(reference_years))
+        for (year, kind, reference), (_, _, optimized) in \
+            zip(Verifier.get_results(reference_years), Verifier.get_results(optimized_years)):
+            if kind in ('books', 'taxes'):
+                reference = [entry for entry in reference if abs(entry[1]) >= SUB_CENT]
+                optimized = [entry for entry in optimized if abs(entry[1]) >= SUB_CENT]
+            if len(reference) != len(optimized):
+                return '{} {}: {} entries instead of {}'.format(year, kind, len(optimized),
+                                                               len(reference))
+            for (reference_name, reference_amount), (optimized_name, optimized_amount) in \
+                zip(reference, optimized):
+                if reference_name != optimized_name or \
+                   not self.is_close(reference_amount, optimized_amount):
+                    return '{} {}: {} {} instead of {} {}'.format(
+                        year, kind, optimized_name, optimized_amount, reference_name,
+                        reference_amount)
+        return None
+
+    def check(self, cfg, years):
+        """ Return a tuple of
+        - whether cfg is valid, meaning the reference engine simulates it without error
+        - description of the first difference or None if results match
+        - speed ratio of the optimized engine over the reference engine """
+        try:
+            reference_years, reference_time = self.run(cfg, years, main.ENGINE_REFERENCE)
+        except Exception: # pylint: disable=broad-except
+            return False, None, None
+        try:
+            optimized_years, optimized_time = self.run(cfg, years, self.engine)
+        except Exception as error: # pylint: disable=broad-except
+            return True, 'failed with {!r}'.format(error), None
+        return True, self.compare(reference_years, optimized_years), \
+            reference_time / max(optimized_time, 1e-9)
+
+    @staticmethod
+    def get_reductions(cfg, years):
+        """ Generate smaller variations of a configuration as tuples of cfg and years """
+        if years > 1:
+            yield cfg, years // 2
+            yield cfg, years - 1
+        entries = cfg[main.CONFIG_INCOME_EXPENSES]
+        for index in range(len(entries)):
+            if len(entries) > 1:
+                reduced = copy.deepcopy(cfg)
+                del reduced[main.CONFIG_INCOME_EXPENSES][index]
+                yield reduced, years
+        for acct_name in cfg[main.CONFIG_ACCTS]:
+            if acct_name not in (main.KEY_SAVINGS_ACCT, 'Investment'):
+                reduced = copy.deepcopy(cfg)
+                del reduced[main.CONFIG_ACCTS][acct_name]
+                yield reduced, years
+        # Drop optional keys and increase list entries of accounts and income/expenses
+        sections = [(main.CONFIG_ACCTS, acct_name) for acct_name in cfg[main.CONFIG_ACCTS]]
+        sections += [(main.CONFIG_INCOME_EXPENSES, index) for index in range(len(entries))]
+        for section, index in sections:
+            for key in cfg[section][index]:
+                if key in REQUIRED_KEYS:
+                    continue
+                reduced = copy.deepcopy(cfg)
+                del reduced[section][index][key]
+                yield reduced, years
+                value = cfg[section][index][key]
+                if isinstance(value, list):
+                    for value_index in range(len(value)):
+                        reduced = copy.deepcopy(cfg)
+                        del reduced[section][index][key][value_index]
+                        yield reduced, years
+
+    def minimize(self, cfg, years):
+        """ Reduce a failing configuration as long as it keeps failing """
+        reduced = True
+        while reduced:
+            reduced = False
+            for candidate_cfg, candidate_years in Verifier.get_reductions(cfg, years):
+                valid, difference = self.check(candidate_cfg, candidate_years)[:2]
+                if valid and difference is not None:
+                    cfg, years = candidate_cfg, candidate_years
+                    reduced = True
+                    break
+        return cfg, years
+
+#------------------ Main loop
+
+def verify():
+    """ Verification main entry point """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--engine", help="optimized engine to verify",
+                        choices=sorted(main.ENGINES), default=main.ENGINE_FAST)
+    parser.add_argument("-n", "--configs", help="number of fuzzed configurations", type=int,
+                        default=100)
+    parser.add_argument("--seed", help="random seed of the fuzzer", type=int, default=0)
+    parser.add_argument("--years", help="maximum years simulated per configuration", type=int,
+                        default=60)
+    parser.add_argument("--rel-tolerance", type=float,
+                        help="relative tolerance of amounts, defaults to 1e-5 for the cents "
+                             "engine and 1e-9 otherwise")
+    parser.add_argument("--abs-tolerance", type=float,
+                        help="absolute tolerance of amounts, defaults to 25 for the cents engine "
+                             "and 1e-6 otherwise")
+    args = parser.parse_args()
+    rel_tolerance, abs_tolerance = TOLERANCES.get(args.engine, DEFAULT_TOLERANCES)
+    if args.rel_tolerance is not None:
+        rel_tolerance = args.rel_tolerance
+    if args.abs_tolerance is not None:
+        abs_tolerance = args.abs_tolerance
+
+    start_year = datetime.datetime.now().year
+    rng = random.Random(args.seed)
+    fuzzer = ConfigFuzzer(rng, start_year)
+    verifier = Verifier(args.engine, start_year, rel_tolerance, abs_tolerance)
+    failures = 0
+    ratios = []
+    for index in range(args.configs):
+        cfg = fuzzer.config()
+        years = rng.randint(1, args.years)
+        valid, difference, ratio = verifier.check(cfg, years)
+        if not valid:
+            print 'Config {}: skipped, rejected by reference engine'.format(index)
+            continue
+        if difference is None:
+            ratios.append(ratio)
+            print 'Config {}: {} years, {} accounts, match, speed-up {:.2f}x' \
+                .format(index, years, len(cfg[main.CONFIG_ACCTS]), ratio)
+            continue
+        failures += 1
+        print 'Config {}: {} years, {} accounts, MISMATCH {}' \
+            .format(index, years, len(cfg[main.CONFIG_ACCTS]), difference)
+        cfg, years = verifier.minimize(cfg, years)
+        print 'Minimized to {} years, {}'.format(years, verifier.check(cfg, years)[1])
+        print json.dumps(cfg, indent=4, sort_keys=True)
+
+    if ratios:
+        # Geometric mean since speed-ups multiply
+        mean_ratio = 1.0
+        for ratio in ratios:
+            mean_ratio *= ratio ** (1.0 / len(ratios))
+        print 'Mean speed-up {:.2f}x over {} matching configs'.format(mean_ratio, len(ratios))
+    print '{} mismatching configs'.format(failures)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    verify()